@@ -1,16 +1,30 @@
 import json
 import re
+import threading
+import time
 
 import requests
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
 from json.decoder import JSONDecodeError
 from functools import wraps
+from typing import Iterable, Generator, List, Union
 from dataclasses import dataclass
 from abc import abstractmethod, ABC
+from urllib3.exceptions import NewConnectionError
+
+ROUND_ROBIN, LEAST_IN_FLIGHT = 'round_robin', 'least_in_flight'
+# 节点不可用（网关错误或节点重启中），剔除后换节点重试
+_UNAVAILABLE_STATUS = {502, 503, 504}
+_NODE_ERRORS = (
+    requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError
+)
 
 
 @dataclass
 class DBC(ABC):
-    host: str = '127.0.0.1'
+    host: Union[str, List[str]] = '127.0.0.1'
     port: int = None
     user: str = ''
     password: str = ''
@@ -18,16 +32,26 @@ class DBC(ABC):
     version: int = None
     base_url: str = None
 
+    # 节点池参数由子类在自身字段之后声明为dataclass字段，避免改变已有字段的位置参数顺序
+    strategy = ROUND_ROBIN
+    eject_seconds = 30
     _ping_prefix = None
     _ping_result = None
 
     def __post_init__(self):
-        if not self.base_url:
+        if self.base_url:
+            urls = [self.base_url]
+        elif isinstance(self.host, str):
             protocol, self.host = re.findall("^(https?://)?(.*?)$", self.host)[0]
-            self.base_url = f'{protocol or "http://"}{f"{self.user}:{self.password}@" if self.user else ""}{self.host}:{self.port}'
+            urls = [self._node_url(f'{protocol}{self.host}')]
+        else:
+            urls = [self._node_url(host) for host in self.host]
+        self._pool = NodePool(urls, strategy=self.strategy, eject_seconds=self.eject_seconds)
+        # base_url保留第一个节点，兼容单节点用法
+        self.base_url = urls[0]
 
         if self._ping_prefix is not None and not self.version:
-            ping = requests.get(f'{self.base_url}{self._ping_prefix}', verify=False)
+            ping = self._request('get', self._ping_prefix)
             if ping.status_code != 200:
                 raise ConnectionError(f'无法连接到{self.__class__.__name__}服务器，请检查配置是否正确\n\t{ping.text}\n'
                                       f'若确定服务器地址无误，可手动指定version参数关闭服务器连接检查')
@@ -38,6 +62,47 @@ class DBC(ABC):
         if not self.version:
             self.version = self._version
 
+    def _node_url(self, host: str):
+        protocol, host = re.findall("^(https?://)?(.*?)$", host)[0]
+        port = '' if re.search(r':\d+$', host) else f':{self.port}'
+        return f'{protocol or "http://"}{f"{self.user}:{self.password}@" if self.user else ""}{host}{port}'
+
+    def _request(self, method: str, path: str, idempotent: bool = None, retry_after_send: bool = None,
+                 **kwargs) -> requests.Response:
+        """
+        从节点池选择节点发送请求。连接失败、超时或节点不可用时剔除该节点
+        连接未建立时任何请求都换节点重试；幂等请求（默认GET、HEAD）在节点返回502/503/504时也换节点重试
+        retry_after_send（默认同idempotent）控制请求可能已到达节点后（读超时、响应中断）是否重试，
+        有状态的请求（如scroll翻页）应关闭，否则会跳过数据
+        """
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        if retry_after_send is None:
+            retry_after_send = idempotent
+        kwargs.setdefault('verify', False)
+        tried, error = [], None
+        while len(tried) < len(self._pool):
+            node = self._pool.select(exclude=tried)
+            tried.append(node)
+            try:
+                with self._pool.use(node):
+                    res = requests.request(method, f'{node.url}{path}', **kwargs)
+            except _NODE_ERRORS as e:
+                # 读超时或响应中断说明节点无响应（GC停顿、半宕机），同样剔除
+                self._pool.mark_failed(node)
+                if retry_after_send or _is_connect_error(e):
+                    error = e
+                    continue
+                raise
+            if res.status_code in _UNAVAILABLE_STATUS:
+                self._pool.mark_failed(node)
+                if idempotent and len(tried) < len(self._pool):
+                    continue
+            else:
+                self._pool.mark_ok(node)
+            return res
+        raise error
+
     @abstractmethod
     def query(self, *args, **kwargs):
         pass
@@ -72,16 +137,161 @@ def http_json_res_parse(_func=None, *, is_return=True):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            res = func(*args, **kwargs)
-            if res.status_code >= 300:
-                raise ConnectionError(f'操作执行失败，错误码：[{res.status_code}]\n{res.text}')
-            else:
-                if is_return:
-                    try:
-                        return json.loads(res.text)
-                    except JSONDecodeError:
-                        raise ValueError(f'返回对象不是JSON字符串\n{res.text}')
+            return parse_json_res(func(*args, **kwargs), is_return=is_return)
 
         return wrapper
 
     return decorator(_func) if _func else decorator
+
+
+def parse_json_res(res: requests.Response, is_return=True):
+    if res.status_code >= 300:
+        raise ConnectionError(f'操作执行失败，错误码：[{res.status_code}]\n{res.text}')
+    else:
+        if is_return:
+            try:
+                return json.loads(res.text)
+            except JSONDecodeError:
+                raise ValueError(f'返回对象不是JSON字符串\n{res.text}')
+
+
+class AdaptiveBatcher:
+    """
+    按字节数切分批次，并根据每批的响应耗时和服务端拒绝（429）动态调整批大小
+    batch_bytes为批大小上限，耗时超过target_latency时按比例缩小，低于时逐步恢复；被拒绝时减半并退避重试
+    """
+    MIN_RATIO = 32
+    MAX_BACKOFF = 30
+
+    def __init__(self, batch_bytes: int = None, target_latency: float = None, max_count: int = None,
+                 max_retries: int = 8, sep_bytes: int = 0):
+        self.max_bytes = batch_bytes or 10 * 1024 * 1024
+        self.min_bytes = self.max_bytes // self.MIN_RATIO
+        self.batch_bytes = self.max_bytes
+        self.target_latency = target_latency
+        self.max_count = max_count
+        self.max_retries = max_retries
+        self.sep_bytes = sep_bytes
+        self._queue = deque()
+        self._rejections = 0
+
+    def batches(self, items: Iterable[str]) -> Generator[list, None, None]:
+        items = iter(items)
+        while True:
+            batch, size = [], 0
+            while not self.max_count or len(batch) < self.max_count:
+                item = self._queue.popleft() if self._queue else next(items, None)
+                if item is None:
+                    break
+                item_size = len(item) + self.sep_bytes
+                # 单条超过批大小时单独成批
+                if batch and size + item_size > self.batch_bytes:
+                    self._queue.appendleft(item)
+                    break
+                batch.append(item)
+                size += item_size
+            if not batch:
+                return
+            yield batch
+
+    def feedback(self, latency: float):
+        self._rejections = 0
+        if self.target_latency:
+            factor = min(max(self.target_latency / max(latency, 1e-3), 0.5), 1.5)
+        else:
+            factor = 1.5
+        self.batch_bytes = min(max(int(self.batch_bytes * factor), self.min_bytes), self.max_bytes)
+
+    def reject(self, items: list, status: int = 429):
+        # 被拒绝的条目放回队首，下一批优先重新提交
+        if status == 413:
+            # 请求体过大与写入压力无关：不退避，按本批实际大小减半直到单条，单条仍超限则无法写入
+            if len(items) == 1:
+                raise ValueError(f'单条数据（{len(items[0])}字节）超过服务端请求体大小限制，无法写入')
+            self._queue.extendleft(reversed(items))
+            # 被拒绝的大小作为新的上限，避免之后按耗时放大批次时再次超限
+            size = sum(len(item) + self.sep_bytes for item in items)
+            self.max_bytes = min(self.max_bytes, size - 1)
+            self.min_bytes = min(self.min_bytes, self.max_bytes)
+            self.batch_bytes = min(self.batch_bytes, size) // 2
+            return
+        self._rejections += 1
+        if self._rejections > self.max_retries:
+            raise ConnectionError(f'服务端连续{self.max_retries}次拒绝写入请求，请降低写入压力后重试')
+        self._queue.extendleft(reversed(items))
+        self.batch_bytes = max(self.batch_bytes // 2, self.min_bytes)
+        time.sleep(min(0.5 * 2 ** (self._rejections - 1), self.MAX_BACKOFF))
+
+
+@dataclass(eq=False)
+class Node:
+    url: str
+    in_flight: int = 0
+    failures: int = 0
+    ejected_until: float = 0
+
+
+class NodePool:
+    """
+    多节点负载均衡，支持轮询（round_robin）和最少在途请求（least_in_flight）
+    失败节点按eject_seconds指数增长的时间被剔除，所有节点均被剔除时仍选择最早恢复的节点
+    """
+    MAX_EJECT_SECONDS = 300
+    # 限制指数，避免单个故障节点连续失败后2 ** failures溢出
+    MAX_EJECT_EXPONENT = 16
+
+    def __init__(self, urls: List[str], strategy: str = ROUND_ROBIN, eject_seconds: float = 30):
+        if strategy not in (ROUND_ROBIN, LEAST_IN_FLIGHT):
+            raise ValueError(f'strategy必须是{ROUND_ROBIN}或{LEAST_IN_FLIGHT}，当前（{strategy}）')
+        self.strategy = strategy
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._counter = count()
+        self.nodes = [Node(url) for url in urls]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def set_urls(self, urls: List[str]):
+        with self._lock:
+            current = {node.url: node for node in self.nodes}
+            self.nodes = [current.get(url) or Node(url) for url in urls]
+
+    def select(self, exclude=()) -> Node:
+        with self._lock:
+            candidates = [node for node in self.nodes if node not in exclude] or self.nodes
+            now = time.monotonic()
+            alive = [node for node in candidates if node.ejected_until <= now]
+            if not alive:
+                return min(candidates, key=lambda node: node.ejected_until)
+            if self.strategy == LEAST_IN_FLIGHT:
+                return min(alive, key=lambda node: node.in_flight)
+            return alive[next(self._counter) % len(alive)]
+
+    @contextmanager
+    def use(self, node: Node):
+        with self._lock:
+            node.in_flight += 1
+        try:
+            yield node
+        finally:
+            with self._lock:
+                node.in_flight -= 1
+
+    def mark_failed(self, node: Node):
+        with self._lock:
+            node.failures += 1
+            node.ejected_until = time.monotonic() + min(
+                self.eject_seconds * 2 ** min(node.failures - 1, self.MAX_EJECT_EXPONENT), self.MAX_EJECT_SECONDS
+            )
+
+    def mark_ok(self, node: Node):
+        if node.failures:
+            with self._lock:
+                node.failures, node.ejected_until = 0, 0
+
+
+def _is_connect_error(e: requests.exceptions.RequestException):
+    # 请求未发送到服务端（连接被拒绝或连接超时），任何请求都可以安全重试
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.exceptions.ConnectTimeout) or isinstance(reason, NewConnectionError)
@@ -1,11 +1,10 @@
-import requests
 import json
 import re
 from dataclasses import dataclass
 from typing import Iterator, Generator, Union
 from itertools import islice
 
-from .dbc import DBC, http_json_res_parse
+from .dbc import DBC, AdaptiveBatcher, ROUND_ROBIN, http_json_res_parse, parse_json_res
 from bools.functools import catch
 from bools.log import Logger
 
@@ -13,27 +12,44 @@ TEMPLATE_NAME = 'bowaer'
 _HEADERS = {
     'Content-type': 'application/json'
 }
+# 请求体过大或被限流时缩小批次重试
+_RETRY_STATUS = {413, 429}
 
 
 @dataclass
 class ElasticSearch(DBC):
     port: int = 9200
     type: str = '_doc'
+    sniff: bool = False
+    strategy: str = ROUND_ROBIN
+    eject_seconds: float = 30
 
     _ping_prefix = ''
 
     def __post_init__(self):
         super().__post_init__()
         self.type_url = f'{self.type}/' if self.version <= 6 else ''
+        if self.sniff:
+            self.sniff_nodes()
+
+    def sniff_nodes(self):
+        """通过_nodes/http获取集群中所有开启http的节点，替换当前节点池"""
+        nodes = parse_json_res(self._request('get', '/_nodes/http'))['nodes'].values()
+        # publish_address格式为ip:port或hostname/ip:port
+        addresses = [node['http']['publish_address'].rsplit('/', 1)[-1] for node in nodes if 'http' in node]
+        if addresses:
+            protocol = re.findall("^(https?://)", self.base_url)[0]
+            self._pool.set_urls([self._node_url(f'{protocol}{address}') for address in addresses])
 
     @property
     def _version(self):
         return int(self._ping_result.json()['version']['number'][0])
 
-    def write(self, index: str, data: Iterator[dict], batch_size=10000, timeout=180):
+    def write(self, index: str, data: Iterator[dict], batch_size=10000, timeout=180,
+              batch_bytes: int = None, target_latency: float = None):
         return self._batch_write(
             index=index, ndjsons=('{"index":{}}\n' + json.dumps(item) + '\n' for item in data),
-            batch_size=batch_size, timeout=timeout
+            batch_size=batch_size, timeout=timeout, batch_bytes=batch_bytes, target_latency=target_latency
         )
 
     @http_json_res_parse
@@ -41,8 +57,8 @@ class ElasticSearch(DBC):
         if 'sort' not in query_body and not sort_by_score:
             # 不要求按照分数排序搜索会更快一些
             query_body['sort'] = ['_doc']
-        url = f'{self.base_url}/{index}/_search{f"?scroll={timeout // 60}m&ignore_unavailable=true" if create_scroll else ""}'
-        return requests.get(url, headers=_HEADERS, data=json.dumps(query_body), timeout=timeout, verify=False)
+        path = f'/{index}/_search{f"?scroll={timeout // 60}m&ignore_unavailable=true" if create_scroll else ""}'
+        return self._request('get', path, headers=_HEADERS, data=json.dumps(query_body), timeout=timeout)
 
     def scroll_query(self, index, query_body: dict, batch_size=1000, timeout=180, total_size=None, log=False):
         if 'size' not in query_body:
@@ -51,13 +67,14 @@ class ElasticSearch(DBC):
         expect_count = total_size or (
             result['hits']['total'] if self.version <= 6 else result['hits']['total']['value']
         )
-        scroll_url = f'{self.base_url}/_search/scroll'
         scroll_data = json.dumps({'scroll_id': result['_scroll_id'], 'scroll': f'{timeout // 60}m'})
         hits, cost = result['hits']['hits'], 0
         while True:
-            res = requests.post(
-                scroll_url, data=scroll_data,
-                headers=_HEADERS, timeout=timeout, verify=False
+            # scroll上下文保存在分片上，任意节点均可继续翻页
+            # 但请求到达节点后游标即前移，读超时等情况重试会跳过一页，只在请求未到达节点时重试
+            res = self._request(
+                'post', '/_search/scroll', idempotent=True, retry_after_send=False, data=scroll_data,
+                headers=_HEADERS, timeout=timeout
             ).json()
             if 'error' in res or not res['hits']['hits'] or len(hits) >= expect_count:
                 if len(hits) < expect_count:
@@ -73,27 +90,35 @@ class ElasticSearch(DBC):
 
     @http_json_res_parse
     def delete(self, index_pattern):
-        return requests.delete(f'{self.base_url}/{index_pattern}', verify=False)
+        return self._request('delete', f'/{index_pattern}')
 
     @http_json_res_parse
     def create_or_cover(self, index: str, document: Union[str, dict], doc_id: str = None):
         if isinstance(document, dict):
             document = json.dumps(document)
-        return requests.post(
-            f'{self.base_url}/{index}/_doc/{doc_id if doc_id else ""}',
+        return self._request(
+            'post', f'/{index}/_doc/{doc_id if doc_id else ""}',
             headers=_HEADERS, data=document
         )
 
     @http_json_res_parse
     def _write(self, index, ndjson_data: str, timeout):
-        return requests.post(
+        return self._bulk(index, ndjson_data, timeout)
+
+    def _bulk(self, index, ndjson_data: str, timeout):
+        return self._request(
             # 如果url没有指定index，则调用方在action中指定
-            url=f'{self.base_url}/{f"{index}/" if index else "/"}{self.type_url}_bulk',
-            data=ndjson_data, headers=_HEADERS, timeout=timeout, verify=False
+            'post', f'/{f"{index}/" if index else "/"}{self.type_url}_bulk',
+            data=ndjson_data, headers=_HEADERS, timeout=timeout
         )
 
-    def _batch_write(self, index, ndjsons: Generator[str, None, None], batch_size, timeout):
+    def _batch_write(self, index, ndjsons: Generator[str, None, None], batch_size, timeout,
+                     batch_bytes=None, target_latency=None):
         self._check_template(index if index.endswith("*") else re.split(r'\W', index)[0] + '*')
+        if batch_bytes or target_latency:
+            return self._adaptive_batch_write(
+                index, ndjsons, AdaptiveBatcher(batch_bytes, target_latency, max_count=batch_size), timeout
+            )
         while True:
             items = list(islice(ndjsons, batch_size))
             if not items:  # ES bulk操作body不能为空
@@ -107,9 +132,34 @@ class ElasticSearch(DBC):
                     ][:10]
                 ))
 
+    def _adaptive_batch_write(self, index, ndjsons: Generator[str, None, None], batcher: AdaptiveBatcher, timeout):
+        for items in batcher.batches(ndjsons):
+            res = self._bulk(index=index, ndjson_data=''.join(items), timeout=timeout)
+            if res.status_code in _RETRY_STATUS:
+                batcher.reject(items, res.status_code)
+                continue
+            write_result = parse_json_res(res)
+            if write_result.get('errors') is not True:
+                batcher.feedback(res.elapsed.total_seconds())
+                continue
+
+            # 只重新提交被拒绝（es_rejected_execution_exception）的条目，其余错误照常输出
+            rejected, errors = [], []
+            for item, result in zip(items, write_result.get('items', [])):
+                action = next(iter(result.values()), {})
+                if action.get('status') == 429:
+                    rejected.append(item)
+                elif 'error' in action:
+                    errors.append(str(action['error']))
+            if errors:
+                Logger.error('\n'.join(errors[:10]))
+            if rejected:
+                batcher.reject(rejected)
+            else:
+                batcher.feedback(res.elapsed.total_seconds())
+
     def _check_template(self, index_pattern):
-        url = f'{self.base_url}/_template/{TEMPLATE_NAME}'
-        current_templates = requests.get(url, verify=False).json()
+        current_templates = self._request('get', f'/_template/{TEMPLATE_NAME}').json()
         patterns = current_templates[TEMPLATE_NAME]['index_patterns'] if current_templates else []
         if index_pattern not in patterns:
             current_templates = {
@@ -146,8 +196,7 @@ class ElasticSearch(DBC):
 
     @http_json_res_parse
     def put_templates(self, templates: dict, template_name):
-        url = f'{self.base_url}/_template/{template_name}'
-        return requests.put(url, headers=_HEADERS, data=json.dumps(templates), verify=False)
+        return self._request('put', f'/_template/{template_name}', headers=_HEADERS, data=json.dumps(templates))
 
     def _patch_pandas(self):
         import pandas as pd
@@ -155,7 +204,8 @@ class ElasticSearch(DBC):
         from pandas.core.dtypes.dtypes import DatetimeTZDtype
 
         def to_es(inner_self: pd.DataFrame, index=None, index_col=None, id_col=None,
-                  numeric_detection=False, batch_size=10000, timeout=180, copy=True):
+                  numeric_detection=False, batch_size=10000, timeout=180, copy=True,
+                  batch_bytes: int = None, target_latency: float = None):
             if inner_self.empty:
                 return
 
@@ -187,7 +237,8 @@ class ElasticSearch(DBC):
                 for name_tuple in _self.itertuples()
             )
             return self._batch_write(
-                index=_self.index[0], ndjsons=ndjsons, batch_size=batch_size, timeout=timeout
+                index=_self.index[0], ndjsons=ndjsons, batch_size=batch_size, timeout=timeout,
+                batch_bytes=batch_bytes, target_latency=target_latency
             )
 
         def read_es(index, query_body: dict, batch_size=1000, timeout=180, total_size=None, log=False):
@@ -1,24 +1,28 @@
-import requests
 from dataclasses import dataclass
 from typing import Generator, Iterator, Union
 from itertools import islice
 from collections import namedtuple
 
-from .dbc import DBC, http_json_res_parse
+from .dbc import DBC, AdaptiveBatcher, ROUND_ROBIN, http_json_res_parse, parse_json_res
 
 _CREATE, _DROP = 'CREATE', 'DROP'
 _DATABASE, _MEASUREMENT = 'database', 'measurement'
+# 请求体过大、限流或服务端过载时缩小批次整批重试
+_RETRY_STATUS = {413, 429, 503}
 
 
 @dataclass
 class InfluxDB(DBC):
     port: int = 8086
     database: str = None
+    strategy: str = ROUND_ROBIN
+    eject_seconds: float = 30
 
     _ping_prefix = '/ping?verbose=true'
 
     def __post_init__(self):
         super().__post_init__()
+        # 仅指向第一个节点，保留用于兼容，内部请求经节点池发送
         self.query_url = f'{self.base_url}/query'
         self.write_url = f'{self.base_url}/write'
 
@@ -29,23 +33,38 @@ class InfluxDB(DBC):
     @http_json_res_parse
     def query(self, influxql: str, database: str = None, batch_size=10000, timeout=180):
         database = self._check_database(database)
-        query_url = f'{self.query_url}?db={database}&pretty=false&chunked={batch_size}&q={influxql}'
-        return requests.get(query_url, timeout=timeout, verify=False)
+        path = f'/query?db={database}&pretty=false&chunked={batch_size}&q={influxql}'
+        return self._request('get', path, timeout=timeout)
 
     def write(self, points: Union[Iterator, Generator], database: str = None, precision='n',
-              batch_size=10000, timeout=180):
+              batch_size=10000, timeout=180, batch_bytes: int = None, target_latency: float = None):
         database = self._check_database(database)
         points = (point for point in points)
+        if batch_bytes or target_latency:
+            batcher = AdaptiveBatcher(batch_bytes, target_latency, max_count=batch_size, sep_bytes=1)
+            return self._adaptive_write(points, batcher, database=database, precision=precision, timeout=timeout)
         while True:
             items = list(islice(points, batch_size))
             if not items:
                 break
             self._write(points=items, database=database, precision=precision, timeout=timeout)
 
+    def _adaptive_write(self, points: Iterator[str], batcher: AdaptiveBatcher, database, precision, timeout):
+        for items in batcher.batches(points):
+            res = self._post_points(points=items, database=database, precision=precision, timeout=timeout)
+            if res.status_code in _RETRY_STATUS:
+                batcher.reject(items, res.status_code)
+                continue
+            parse_json_res(res, is_return=False)
+            batcher.feedback(res.elapsed.total_seconds())
+
     @http_json_res_parse(is_return=False)
     def _write(self, points: list, database, precision, timeout):
-        write_url = f'{self.write_url}?db={database}&precision={precision}'
-        return requests.post(write_url, data='\n'.join(points), timeout=timeout, verify=False)
+        return self._post_points(points=points, database=database, precision=precision, timeout=timeout)
+
+    def _post_points(self, points: list, database, precision, timeout):
+        path = f'/write?db={database}&precision={precision}'
+        return self._request('post', path, data='\n'.join(points), timeout=timeout)
 
     def drop_measurement(self, measurement: str, database: str = None):
         self.action(f'{_DROP} {_MEASUREMENT} "{measurement}"', self._check_database(database))
@@ -58,7 +77,7 @@ class InfluxDB(DBC):
 
     @http_json_res_parse(is_return=False)
     def action(self, influxql, database=''):
-        return requests.post(f'{self.query_url}?db={database}&q={influxql}', verify=False)
+        return self._request('post', f'/query?db={database}&q={influxql}')
 
     def _patch_pandas(self):
         import pandas as pd
@@ -79,7 +98,8 @@ class InfluxDB(DBC):
 
         def to_influxdb(inner_self: pd.DataFrame, measurement=None, measurement_col=None,
                         tag_cols=None, time_col='_index', database: str = None,
-                        batch_size=10000, timeout=180, copy=True):
+                        batch_size=10000, timeout=180, copy=True,
+                        batch_bytes: int = None, target_latency: float = None):
             _self = inner_self.copy() if copy else inner_self
             if _self.empty:
                 return
@@ -139,7 +159,10 @@ class InfluxDB(DBC):
                 f' {name_tuple[0]}'
                 for name_tuple in _self.itertuples()
             )
-            self.write(points=points, database=database, batch_size=batch_size, timeout=timeout)
+            self.write(
+                points=points, database=database, batch_size=batch_size, timeout=timeout,
+                batch_bytes=batch_bytes, target_latency=target_latency
+            )
 
         pd.read_influxdb = read_influxdb
         pd.DataFrame.to_influxdb = to_influxdb
@@ -1,4 +1,14 @@
+import asyncio
+import itertools
+import os
+import pickle
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, namedtuple
 from functools import wraps
+from inspect import unwrap
 from typing import Union, Tuple
 
 from bools.log import Logger
@@ -52,6 +62,8 @@ def parallel(func=None, count: int = None):
 
     def inner(data: list):
         from multiprocessing import Pool
+        # shared_memoize的Manager进程需在fork子进程前启动
+        _SharedCache.start_all()
         with Pool(count) as p:
             result = p.map(_outer_func, data)
         return result
@@ -64,4 +76,313 @@ _FUNC = 'func'
 
 def _outer_func(*args, **kwargs):
     func = getattr(_outer_func, _FUNC)
-    return func(*args, **kwargs) if func.__code__.co_argcount else func()
+    # 被装饰函数的wrapper参数为*args，需检查原函数的参数个数
+    return func(*args, **kwargs) if unwrap(func).__code__.co_argcount else func()
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'bytes'])
+
+
+def memoize(_func=None, *, maxsize: int = 128, ttl: float = None, max_bytes: int = None):
+    """
+    缓存装饰器，支持LRU、TTL淘汰及最大字节数限制
+    并发调用同一参数时只计算一次，其余调用等待其结果。同步函数与async函数均支持
+    """
+
+    def decorator(func):
+        return _memoize(func, _Cache(maxsize, ttl, max_bytes))
+
+    return decorator(_func) if _func else decorator
+
+
+def shared_memoize(_func=None, *, maxsize: int = 128, ttl: float = None, max_bytes: int = None):
+    """
+    跨进程共享的memoize，缓存存放于multiprocessing.Manager进程中，可在parallel的子进程间共享
+    Manager进程在首次调用或parallel创建子进程时启动。需在fork子进程前完成装饰，参数和返回值必须可以pickle
+    """
+
+    def decorator(func):
+        return _memoize(func, _SharedCache(maxsize, ttl, max_bytes))
+
+    return decorator(_func) if _func else decorator
+
+
+def _memoize(func, cache: '_Cache'):
+    if cache.maxsize == 0:
+        # 不缓存时也无需去重，避免并发调用被串行化
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                cache.record(hit=False)
+                return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                cache.record(hit=False)
+                return func(*args, **kwargs)
+    elif asyncio.iscoroutinefunction(func):
+        # 协程只在同一事件循环内去重，Future按事件循环隔离且仅在计算期间存在
+        loop_futures = weakref.WeakKeyDictionary()
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            loop = asyncio.get_running_loop()
+            futures = loop_futures.setdefault(loop, {})
+            while True:
+                found, value = cache.get(key)
+                if found:
+                    cache.record(hit=True)
+                    return value
+                future = futures.get(key)
+                if future is None:
+                    break
+                # 直接取计算中的结果，不依赖结果是否写入缓存；计算失败时重新竞争
+                value = await asyncio.shield(future)
+                if value is not _MISSING:
+                    cache.record(hit=True)
+                    return value
+
+            cache.record(hit=False)
+            futures[key] = future = loop.create_future()
+            value = _MISSING
+            try:
+                value = await func(*args, **kwargs)
+                cache.set(key, value)
+                return value
+            finally:
+                del futures[key]
+                future.set_result(value)
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            found, value = cache.acquire(key)
+            if found:
+                return value
+            token = value
+            try:
+                value = func(*args, **kwargs)
+            except BaseException:
+                cache.release(key, token)
+                raise
+            cache.release(key, token, value)
+            return value
+
+    wrapper.cache_info = cache.info
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+_KWARGS_MARK = (object,)
+_MISSING = object()
+_TOKENS = itertools.count()
+
+
+def _make_key(args, kwargs):
+    return args + _KWARGS_MARK + tuple(sorted(kwargs.items())) if kwargs else args
+
+
+def _sizeof(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        # windows下os.kill(pid, 0)会结束进程
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Cache:
+    _clock = staticmethod(time.monotonic)
+    # 等待计算结果时定期检查计算方进程是否存活
+    WAIT_TIMEOUT = 1
+
+    def __init__(self, maxsize, ttl, max_bytes):
+        self.maxsize, self.ttl, self.max_bytes = maxsize, ttl, max_bytes
+        self._cond = threading.Condition()
+        self._data = OrderedDict()  # key -> (value, expire_at, size)
+        self._pending = {}  # key -> (token, pid, waiters)
+        self._results = {}  # token -> (value, waiters)
+        self._stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+    def get(self, key):
+        with self._cond:
+            return self._get(key)
+
+    def set(self, key, value):
+        with self._cond:
+            self._set(key, value)
+
+    def record(self, hit: bool):
+        with self._cond:
+            self._stats['hits' if hit else 'misses'] += 1
+
+    def acquire(self, key):
+        """
+        命中或等待到其他调用方的计算结果时返回(True, value)
+        未命中时将key标记为计算中并返回(False, token)，调用方计算完成后必须调用release(key, token[, value])
+        """
+        with self._cond:
+            while True:
+                found, value = self._get(key)
+                if found:
+                    self._stats['hits'] += 1
+                    return True, value
+                pending = self._pending.get(key)
+                if pending is None:
+                    break
+                found, value = self._wait(key, *pending)
+                if found:
+                    self._stats['hits'] += 1
+                    return True, value
+            self._stats['misses'] += 1
+            token = (os.getpid(), next(_TOKENS))
+            self._pending[key] = (token, os.getpid(), 0)
+            return False, token
+
+    def release(self, key, token, *value):
+        # 计算抛出异常时不传value，等待中的调用方将重新竞争计算
+        with self._cond:
+            if value:
+                self._set(key, value[0])
+            pending = self._pending.get(key)
+            if pending is not None and pending[0] == token:
+                del self._pending[key]
+                if value and pending[2]:
+                    self._results[token] = (value[0], pending[2])
+            self._cond.notify_all()
+
+    def _wait(self, key, token, pid, waiters):
+        self._pending[key] = (token, pid, waiters + 1)
+        while self._pending.get(key, (None,))[0] == token:
+            if not self._cond.wait(self.WAIT_TIMEOUT) and not _pid_alive(pid):
+                # 计算方进程异常退出，回收计算标记
+                del self._pending[key]
+                self._cond.notify_all()
+                return False, None
+        result = self._results.get(token)
+        if result is None:
+            return False, None
+        value, remain = result
+        if remain > 1:
+            self._results[token] = (value, remain - 1)
+        else:
+            del self._results[token]
+        return True, value
+
+    def info(self):
+        with self._cond:
+            return CacheInfo(
+                self._stats['hits'], self._stats['misses'], self.maxsize, len(self._data), self._stats['bytes']
+            )
+
+    def clear(self):
+        with self._cond:
+            self._data.clear()
+            self._stats.update(hits=0, misses=0, bytes=0)
+
+    def _get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        value, expire_at, _ = entry
+        if expire_at is not None and expire_at <= self._clock():
+            self._pop(key)
+            return False, None
+        self._touch(key)
+        return True, value
+
+    def _set(self, key, value):
+        size = _sizeof(value) if self.max_bytes is not None else 0
+        if self.maxsize == 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        if key in self._data:
+            self._pop(key)
+        self._data[key] = (value, self._clock() + self.ttl if self.ttl is not None else None, size)
+        self._touch(key)
+        self._stats['bytes'] += size
+        while (self.maxsize is not None and len(self._data) > self.maxsize) or \
+                (self.max_bytes is not None and self._stats['bytes'] > self.max_bytes):
+            self._pop(self._oldest())
+
+    def _pop(self, key):
+        self._stats['bytes'] -= self._data.pop(key)[2]
+
+    def _touch(self, key):
+        self._data.move_to_end(key)
+
+    def _oldest(self):
+        return next(iter(self._data))
+
+
+class _SharedCache(_Cache):
+    # 跨进程比较过期时间，使用墙上时钟
+    _clock = staticmethod(time.time)
+    # 所有共享缓存使用同一个Manager进程
+    _manager = None
+    _manager_lock = threading.Lock()
+    _instances = weakref.WeakSet()
+
+    def __init__(self, maxsize, ttl, max_bytes):
+        # 不调用父类初始化，共享对象在start中创建，避免import时即启动Manager进程
+        self.maxsize, self.ttl, self.max_bytes = maxsize, ttl, max_bytes
+        self._shared_cond = None
+        self._instances.add(self)
+
+    @classmethod
+    def start_all(cls):
+        for cache in list(cls._instances):
+            cache.start()
+
+    def start(self):
+        cls = type(self)
+        with cls._manager_lock:
+            if self._shared_cond is not None:
+                return
+            if cls._manager is None:
+                from multiprocessing import Manager
+                # Manager进程在进程内共享并常驻，子进程通过fork继承的代理对象访问
+                cls._manager = Manager()
+            manager = cls._manager
+            self._data = manager.dict()
+            self._pending = manager.dict()
+            self._results = manager.dict()
+            self._stats = manager.dict(hits=0, misses=0, bytes=0, tick=0)
+            self._ticks = manager.dict()
+            self._shared_cond = manager.Condition()
+
+    @property
+    def _cond(self):
+        # 所有公开方法都先获取_cond，首次使用时创建共享对象
+        if self._shared_cond is None:
+            self.start()
+        return self._shared_cond
+
+    def clear(self):
+        with self._cond:
+            super().clear()
+            self._ticks.clear()
+
+    def _pop(self, key):
+        super()._pop(key)
+        self._ticks.pop(key, None)
+
+    def _touch(self, key):
+        # DictProxy无序，用递增计数记录最近访问顺序
+        self._stats['tick'] += 1
+        self._ticks[key] = self._stats['tick']
+
+    def _oldest(self):
+        ticks = self._ticks.copy()
+        return min(ticks, key=ticks.get)